@@ -1,9 +1,16 @@
+import asyncio
+import hashlib
 import requests
 import re
 import os
-import json
 import logging
-from openai import OpenAI
+import math
+import time
+import orjson
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+from requests.adapters import HTTPAdapter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from urllib3.util.retry import Retry
 
 # 配置日志
 logging.basicConfig(
@@ -17,149 +24,396 @@ GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
 GITHUB_EVENT_PATH = os.getenv("GITHUB_EVENT_PATH")
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "8"))  # 同时进行的 AI 请求数上限
+# 每分钟 AI 请求数和 token 数上限，未设置或为 0 时不限速，只受 MAX_CONCURRENCY 限制
+MAX_REQUESTS_PER_MINUTE = float(os.getenv("MAX_REQUESTS_PER_MINUTE") or 0)
+MAX_TOKENS_PER_MINUTE = float(os.getenv("MAX_TOKENS_PER_MINUTE") or 0)
+REVIEW_BATCH_SIZE = 50  # 每个 review 提交的评论数上限
+DIFF_CHUNK_SIZE = 65536  # 流式读取 diff 的块大小
+HUNK_QUEUE_SIZE = 32  # 等待 AI 分析的代码块队列长度
+FEEDBACK_BASE_TOKENS = 150  # 每个代码块反馈的基础 token 数
+FEEDBACK_TOKENS_PER_LINE = 50  # 每个新增行反馈的 token 数
+MAX_FEEDBACK_TOKENS = 1000  # 单个代码块的 AI 反馈 token 上限
+MAX_BATCH_FEEDBACK_TOKENS = 4000  # 一次 AI 请求的反馈 token 上限
+PROMPT_TOKEN_BUDGET = 3000  # 合并到同一次 AI 请求中的 diff token 上限
+MAX_HUNKS_PER_BATCH = 8  # 合并到同一次 AI 请求中的代码块数上限
+CACHE_DIR = os.getenv("AI_REVIEW_CACHE_DIR", os.path.expanduser("~/.cache/ai-code-review"))
 
 # 日志配置
 DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 if not DEBUG:
     logger.setLevel(logging.INFO)
 
-# 初始化 OpenAI 客户端
-client = OpenAI(api_key=OPENAI_API_KEY, base_url="https://api.openai-prc.com/v1")
+# diff 解析用的正则，直接作用于 bytes
+_FILE_BOUNDARY = b"\ndiff --git "
+_FILE_RE = re.compile(rb"^diff --git ", re.M)
+_PATH_RE = re.compile(rb"^\+\+\+ b/(.+)$", re.M)
+# 匹配 "@@ -71,7 +71,6 @@" 格式
+_HUNK_RE = re.compile(rb"^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,(\d+))? @@.*$", re.M)
+# 代码块正文中 "\\ No newline at end of file" 之类的非代码行
+_NON_CONTENT_LINE_RE = re.compile(rb"^[^-+ \n].*\n?", re.M)
+# 新增了非空白内容的行
+_ADDED_CODE_RE = re.compile(rb"^\+[ \t]*\S", re.M)
+# 匹配 AI 反馈中的 "- **Hunk 1 Line 12**: ..." 行
+_FEEDBACK_RE = re.compile(r"^- \*\*Hunk (\d+) Line (\d+)\*\*: (.*)$", re.M)
 
-def get_pr_diff(pr_number, repo, headers):
-    """获取 Pull Request 的 diff"""
+# 初始化 OpenAI 客户端，关闭 SDK 自带的重试，由 create_chat_completion 统一限速和重试
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url="https://api.openai-prc.com/v1", max_retries=0)
+
+# 复用同一个 GitHub 会话，避免每次请求都重新建立 TCP/TLS 连接
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+))
+
+def get_pr_diff(pr_number, repo, commit_id):
+    """获取 Pull Request 的 diff，返回按块读取 diff 内容的生成器"""
     diff_url = f"https://api.github.com/repos/{repo}/pulls/{pr_number}"
-    diff_headers = headers.copy()
-    diff_headers["Accept"] = "application/vnd.github.diff"
+    diff_headers = {"Accept": "application/vnd.github.diff"}
+    
+    # 同一提交重复运行时带上上次的 ETag，diff 未变化时 GitHub 返回 304，不再传输正文
+    cache_path = os.path.join(CACHE_DIR, "diffs", f"{pr_number}-{commit_id}.diff")
+    etag_path = cache_path + ".etag"
+    cached_etag = None
+    if os.path.exists(cache_path):
+        try:
+            with open(etag_path, "r") as f:
+                cached_etag = f.read().strip()
+        except OSError:
+            pass
+    if cached_etag:
+        diff_headers["If-None-Match"] = cached_etag
+    
     logger.info(f"Fetching PR diff from: {diff_url}")
-    response = requests.get(diff_url, headers=diff_headers)
+    # 以流的方式读取 diff，交给 parse_diff 边下载边解析
+    response = SESSION.get(diff_url, headers=diff_headers, stream=True)
     logger.info(f"Diff API response status: {response.status_code}")
-    if response.status_code == 200:
-        return response.text
+    if response.status_code == 304:
+        response.close()
+        logger.info(f"Diff not modified, reading cached diff from {cache_path}")
+        return read_cached_diff(cache_path)
+    elif response.status_code == 200:
+        return stream_diff(response, cache_path, etag_path)
     else:
         logger.error(f"Diff API response content: {response.text[:200]}...")
+        response.close()
         raise Exception(f"Failed to fetch diff: {response.status_code}")
 
-def parse_diff(diff):
-    """解析 diff，提取文件、行号和代码块"""
-    diff_lines = diff.splitlines()
-    logger.info(f"Diff lines: {diff_lines}")
-    file_changes = []
-    current_file = None
-    current_hunk = None
-    file_path = None
-    
-    for line in diff_lines:
-        # 检测新文件的开始
-        if line.startswith("diff --git"):
-            # 保存前一个文件的信息
-            if current_file and current_file["hunks"]:
-                file_changes.append(current_file)
-            
-            # 重置当前文件信息
-            file_path = None
-            current_file = None
-            current_hunk = None
-            
-        # 提取文件路径
-        elif line.startswith("--- a/") or line.startswith("+++ b/"):
-            path = line[6:]  # 跳过 "--- a/" 或 "+++ b/"
-            if line.startswith("+++ b/") and path != "/dev/null":
-                file_path = path
-                current_file = {"file": file_path, "hunks": []}
-                
-        # 解析代码块信息
-        elif line.startswith("@@"):
-            if current_file:  # 确保我们有一个有效的文件
-                if current_hunk:
-                    current_file["hunks"].append(current_hunk)
-                
-                # 匹配 "@@ -71,7 +71,6 @@" 格式
-                hunk_info = re.match(r"@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@", line)
-                if hunk_info:
-                    current_hunk = {
-                        "old_start": int(hunk_info.group(1)),
-                        "new_start": int(hunk_info.group(2)),
-                        "lines": [],
-                        "header": line,  # 保存完整的hunk头信息用于调试
-                        "diff_hunk": line,  # 初始化diff_hunk，后续会添加更多行
-                        "changed_lines": []  # 跟踪添加的行及其行号
-                    }
-                    logger.debug(f"Found hunk: {line} for file {file_path}")
-        
-        # 收集代码行
-        elif current_hunk and current_file and (line.startswith("+") or line.startswith("-") or line.startswith(" ")):
-            current_hunk["lines"].append(line)
-            current_hunk["diff_hunk"] += "\n" + line
-            
-            # 如果是添加的行，记录行号
-            if line.startswith("+") and not line.startswith("+++"):
-                # 计算该行在新文件中的行号
-                line_index = len([l for l in current_hunk["lines"] if l.startswith("+") or l.startswith(" ")]) - 1
-                line_number = current_hunk["new_start"] + line_index
-                current_hunk["changed_lines"].append({
-                    "content": line[1:],  # 去掉前面的 "+"
-                    "line_number": line_number,
-                    "diff_line": line
-                })
-    
-    # 保存最后一个代码块和文件
-    if current_hunk and current_file:
-        current_file["hunks"].append(current_hunk)
-    if current_file and current_file["hunks"]:
-        file_changes.append(current_file)
+def read_cached_diff(cache_path):
+    """按块读取本地缓存的 diff"""
+    with open(cache_path, "rb") as f:
+        while chunk := f.read(DIFF_CHUNK_SIZE):
+            yield chunk
+
+def stream_diff(response, cache_path, etag_path):
+    """按块读取 diff 响应，同时把 diff 和 ETag 写入本地缓存"""
+    etag = response.headers.get("ETag")
+    cache_file = None
+    if etag:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            cache_file = open(cache_path + ".tmp", "wb")
+        except OSError as e:
+            logger.warning(f"Failed to open diff cache {cache_path}: {str(e)}")
     
-    logger.info(f"Found {len(file_changes)} files with changes")
-    for fc in file_changes:
-        logger.info(f"File {fc['file']} has {len(fc['hunks'])} hunks")
-        for i, hunk in enumerate(fc["hunks"]):
-            logger.debug(f"Hunk {i+1}: {hunk['header']} with {len(hunk['lines'])} lines, new_start={hunk['new_start']}")
-            logger.debug(f"  Changed lines in hunk: {len(hunk['changed_lines'])}")
+    try:
+        with response:
+            for chunk in response.iter_content(chunk_size=DIFF_CHUNK_SIZE):
+                if cache_file:
+                    try:
+                        cache_file.write(chunk)
+                    except OSError as e:
+                        # 缓存只是尽力而为，写入失败时放弃缓存，继续读取 diff
+                        logger.warning(f"Failed to write diff cache {cache_path}: {str(e)}")
+                        cache_file.close()
+                        try:
+                            os.remove(cache_path + ".tmp")
+                        except OSError:
+                            pass
+                        cache_file = None
+                yield chunk
+    finally:
+        if cache_file:
+            cache_file.close()
     
-    return file_changes
-
-def analyze_code_with_ai(diff_snippet, hunk_info=None):
-    """使用 OpenAI 分析代码 diff"""
-    hunk_desc = ""
-    if hunk_info:
-        hunk_desc = f"此代码块从第 {hunk_info['new_start']} 行开始。"
-        logger.info(f"Analyzing hunk starting at line {hunk_info['new_start']} with {len(diff_snippet.splitlines())} lines")
+    # 只有完整读取后才替换缓存，避免留下不完整的 diff
+    if cache_file:
+        try:
+            os.replace(cache_path + ".tmp", cache_path)
+            with open(etag_path, "w") as f:
+                f.write(etag)
+        except OSError as e:
+            logger.warning(f"Failed to write diff cache {cache_path}: {str(e)}")
+
+def parse_diff(diff_chunks):
+    """流式解析 diff，每读完一个文件就 yield 该文件的变更信息"""
+    buffer = bytearray()
+    for chunk in diff_chunks:
+        search_start = max(0, len(buffer) - len(_FILE_BOUNDARY))
+        buffer.extend(chunk)
+        
+        # 最后一个 "diff --git" 之前的内容都是完整的文件，可以先解析
+        boundary = buffer.rfind(_FILE_BOUNDARY, search_start)
+        if boundary == -1:
+            continue
+        complete = bytes(buffer[:boundary + 1])
+        del buffer[:boundary + 1]
+        yield from parse_file_diffs(complete)
     
-    prompt = f"""
-    你是一名专业的代码审查者。请审阅以下代码 diff，提供具体的改进建议。
-    关注代码质量、潜在 bug、性能问题和最佳实践。
-    如适用，建议改进代码片段。
-    {hunk_desc}
+    yield from parse_file_diffs(bytes(buffer))
+
+def parse_file_diffs(diff_bytes):
+    """解析一段由完整文件组成的 diff，逐个 yield 文件及其代码块"""
+    # 按 "diff --git" 切分出每个文件的片段
+    file_starts = [m.start() for m in _FILE_RE.finditer(diff_bytes)] + [len(diff_bytes)]
+    for file_start, file_end in zip(file_starts, file_starts[1:]):
+        hunk_matches = list(_HUNK_RE.finditer(diff_bytes, file_start, file_end))
+        if not hunk_matches:
+            continue
+        
+        # 文件路径只在第一个代码块之前的文件头中查找，删除的文件（+++ /dev/null）会被跳过
+        path_match = _PATH_RE.search(diff_bytes, file_start, hunk_matches[0].start())
+        if not path_match:
+            continue
+        file_path = path_match.group(1).decode()
+        current_file = {"file": file_path, "hunks": []}
+        
+        # 相邻两个代码块头之间的内容即为代码块正文
+        hunk_ends = [m.start() for m in hunk_matches[1:]] + [file_end]
+        for hunk_info, hunk_end in zip(hunk_matches, hunk_ends):
+            header = hunk_info.group(0).decode()
+            # 只记录代码块正文在 diff_bytes 中的偏移，需要时再解码，避免为每一行创建字符串
+            current_file["hunks"].append({
+                "old_start": int(hunk_info.group(1)),
+                "new_start": int(hunk_info.group(2)),
+                "new_count": int(hunk_info.group(3) or 1),
+                "header": header,  # 保存完整的hunk头信息用于调试
+                "diff_bytes": diff_bytes,
+                "body_slice": (hunk_info.end(), hunk_end)
+            })
+            logger.debug("Found hunk: %s for file %s", header, file_path)
+        
+        logger.info(f"File {file_path} has {len(current_file['hunks'])} hunks")
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, hunk in enumerate(current_file["hunks"]):
+                start, end = hunk["body_slice"]
+                logger.debug("Hunk %d: %s with %d bytes, new_start=%d", i + 1, hunk["header"], end - start, hunk["new_start"])
+        yield current_file
+
+def get_hunk_snippet(hunk):
+    """按偏移从 diff 中取出代码块正文并解码"""
+    start, end = hunk["body_slice"]
+    body = hunk["diff_bytes"][start:end]
+    # 正文行的首字节只会是 "-"、"+"、" " 或 "\"（No newline 标记），只有出现后者时才需要过滤
+    if b"\n\\" in body:
+        body = _NON_CONTENT_LINE_RE.sub(b"", body)
+    return body.decode(errors="replace").strip("\n")
+
+def count_added_lines(hunk):
+    """统计代码块中新增的行数"""
+    start, end = hunk["body_slice"]
+    # 正文从 hunk 头的行尾开始，每一行前面都有换行符
+    return hunk["diff_bytes"].count(b"\n+", start, end)
+
+def get_new_line_numbers(hunk):
+    """计算代码块 diff 中每一行对应的新文件行号，删除的行（-开头）没有新文件行号，记为 None"""
+    line_numbers = []
+    line_number = hunk["new_start"]
+    for line in get_hunk_snippet(hunk).split("\n"):
+        if line.startswith("-"):
+            line_numbers.append(None)
+        else:
+            line_numbers.append(line_number)
+            line_number += 1
+    return line_numbers
+
+def get_feedback_tokens(hunk):
+    """按新增行数估算单个代码块的反馈需要的 token 数"""
+    # 每条单行反馈约 50 token，另外预留代码块级别的改进建议
+    return min(MAX_FEEDBACK_TOKENS, FEEDBACK_BASE_TOKENS + FEEDBACK_TOKENS_PER_LINE * count_added_lines(hunk))
+
+# 本次运行内的 AI 反馈缓存：缓存路径 -> (反馈内容, 回复是否被截断)
+_feedback_cache = {}
+
+def get_cache_path(prompt):
+    """按模型和 prompt 内容哈希计算缓存文件路径"""
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+    return os.path.join(CACHE_DIR, OPENAI_MODEL.replace("/", "_"), f"{key}.json")
+
+def load_cached_feedback(cache_path):
+    """读取缓存的 AI 反馈，返回 (反馈内容, 是否被截断)，未命中时返回 None"""
+    if cache_path in _feedback_cache:
+        return _feedback_cache[cache_path]
+    try:
+        with open(cache_path, "rb") as f:
+            cached = orjson.loads(f.read())
+        result = (cached["feedback"], cached.get("truncated", False))
+    except (OSError, ValueError, KeyError):
+        return None
+    _feedback_cache[cache_path] = result
+    return result
+
+def save_cached_feedback(cache_path, feedback, truncated):
+    """将 AI 反馈写入缓存，写入失败不影响审查流程"""
+    _feedback_cache[cache_path] = (feedback, truncated)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "wb") as f:
+            f.write(orjson.dumps({"feedback": feedback, "truncated": truncated}))
+    except OSError as e:
+        logger.warning(f"Failed to write feedback cache {cache_path}: {str(e)}")
+
+class RateLimiter:
+    """按每分钟请求数和 token 数限制 AI 请求的令牌桶，上限不大于 0 时该项不限制"""
     
-    Diff:
-    ```diff
-    {diff_snippet}
-    ```
+    def __init__(self, max_requests_per_minute, max_tokens_per_minute):
+        self.max_requests_per_minute = max_requests_per_minute if max_requests_per_minute > 0 else math.inf
+        self.max_tokens_per_minute = max_tokens_per_minute if max_tokens_per_minute > 0 else math.inf
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self._lock = asyncio.Lock()
     
-    返回格式化的反馈：
-    - **Line [line_number]**: [反馈内容]
-    - **建议** (可选): ```[language]\n[建议代码]\n```
+    def _refill(self):
+        """按流逝的时间补充容量"""
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.last_update_time = now
+        self.available_request_capacity = min(
+            self.max_requests_per_minute,
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60
+        )
+        self.available_token_capacity = min(
+            self.max_tokens_per_minute,
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60
+        )
     
-    注意：
-    1. line_number 是相对于 diff 中显示的行号，而不是相对于文件开始的行号
-    2. 请确保为所有新增（+开头）的代码行提供评论，特别是有潜在问题的代码
-    3. 如果没有问题，也请至少提供一条改进建议
-    """
-    logger.debug(f"Sending prompt to OpenAI with {len(prompt)} characters")
-    response = client.chat.completions.create(
+    async def acquire(self, tokens):
+        """等待直到有足够的容量发送一个消耗 tokens 的请求"""
+        if self.max_requests_per_minute == math.inf and self.max_tokens_per_minute == math.inf:
+            return
+        # 单个请求超过每分钟上限时按上限计算，避免永远等待
+        tokens = min(tokens, self.max_tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= tokens
+                    return
+                # 计算补足不足的容量所需的时间
+                wait = 0.01
+                if self.available_request_capacity < 1:
+                    wait = max(wait, (1 - self.available_request_capacity) * 60 / self.max_requests_per_minute)
+                if self.available_token_capacity < tokens:
+                    wait = max(wait, (tokens - self.available_token_capacity) * 60 / self.max_tokens_per_minute)
+                await asyncio.sleep(wait)
+
+rate_limiter = RateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE)
+
+def estimate_tokens(text):
+    """粗略估算文本的 token 数：ASCII 字符约 4 个一个 token，中文等非 ASCII 字符约 1 个一个 token"""
+    char_count = len(text)
+    # UTF-8 下中文字符占 3 个字节，按多出的字节数估算非 ASCII 字符数
+    non_ascii_count = (len(text.encode()) - char_count) // 2
+    return (char_count - non_ascii_count) // 4 + non_ascii_count + 1
+
+@retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError)),
+    reraise=True
+)
+async def create_chat_completion(prompt, max_tokens):
+    """在速率限制内调用 OpenAI，遇到 429、连接错误或服务端错误时指数退避重试"""
+    await rate_limiter.acquire(estimate_tokens(prompt) + max_tokens)
+    return await client.chat.completions.create(
         model=OPENAI_MODEL,
         messages=[{"role": "user", "content": prompt}],
-        max_tokens=1000  # 增加 token 限制以获取更详细的反馈
+        max_tokens=max_tokens,
+        temperature=0.0  # 固定输出，相同的 diff 得到相同的反馈，便于缓存
     )
-    feedback = response.choices[0].message.content
-    logger.debug(f"Received feedback with {len(feedback)} characters")
-    logger.debug(f"Preview of feedback: {feedback[:100]}...")
-    return feedback
-
-def post_comment(pr_number, repo, commit_id, file_path, line_number, comment, headers, diff_hunk=None):
-    """在 Pull Request 的指定 diff 处发表评论"""
-    comment_url = f"https://api.github.com/repos/{repo}/pulls/{pr_number}/comments"
+
+def format_hunk_sections(hunks):
+    """把同一文件的多个代码块拼成带编号分隔的 diff 片段"""
+    sections = []
+    for hunk_number, hunk in enumerate(hunks, start=1):
+        diff_snippet = get_hunk_snippet(hunk)
+        sections.append(f"## Hunk {hunk_number} (从第 {hunk['new_start']} 行开始)\n```diff\n{diff_snippet}\n```")
+    return "\n\n".join(sections)
+
+def batch_hunks(hunks):
+    """将同一文件的代码块按 diff 和反馈的 token 预算分组，每组合并为一次 AI 请求"""
+    batches = []
+    batch = []
+    batch_tokens = 0
+    batch_feedback_tokens = 0
+    for hunk in hunks:
+        start, end = hunk["body_slice"]
+        hunk_tokens = (end - start) // 4 + 1  # 与 estimate_tokens 相同，按字节数估算
+        feedback_tokens = get_feedback_tokens(hunk)
+        if batch and (
+            len(batch) >= MAX_HUNKS_PER_BATCH
+            or batch_tokens + hunk_tokens > PROMPT_TOKEN_BUDGET
+            or batch_feedback_tokens + feedback_tokens > MAX_BATCH_FEEDBACK_TOKENS
+        ):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+            batch_feedback_tokens = 0
+        batch.append(hunk)
+        batch_tokens += hunk_tokens
+        batch_feedback_tokens += feedback_tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+async def analyze_code_with_ai(file_path, hunks):
+    """使用 OpenAI 分析同一文件中一组代码块的 diff，返回反馈内容和回复是否被截断"""
+    logger.info(f"Analyzing {len(hunks)} hunks of {file_path} starting at line {hunks[0]['new_start']}")
+    
+    prompt = f"""
+你是一名专业的代码审查者。请审阅以下文件 {file_path} 的代码 diff，提供具体的改进建议。
+关注代码质量、潜在 bug、性能问题和最佳实践。
+每条反馈只写一行、一两句话，需要改进时直接在反馈中说明改法，不要输出代码块。
+diff 分为 {len(hunks)} 个代码块，每个代码块以 "## Hunk [编号]" 开头。
+
+{format_hunk_sections(hunks)}
+
+返回格式化的反馈：
+- **Hunk [hunk_number] Line [line_number]**: [反馈内容]
+
+注意：
+1. hunk_number 是代码块的编号，line_number 是相对于该代码块 diff 中显示的行号（从 1 开始，删除的行也计入），而不是相对于文件开始的行号
+2. 请确保为所有新增（+开头）的代码行提供评论，特别是有潜在问题的代码
+3. 如果没有问题，也请至少为每个代码块提供一条改进建议
+"""
+    cache_path = get_cache_path(prompt)
+    cached = load_cached_feedback(cache_path)
+    if cached is not None:
+        logger.info(f"Using cached feedback from {cache_path}")
+        return cached
     
+    logger.debug("Sending prompt to OpenAI with %d characters", len(prompt))
+    # 按每个代码块的新增行数确定输出 token 上限，小代码块不必预留完整的额度
+    max_tokens = min(MAX_BATCH_FEEDBACK_TOKENS, sum(get_feedback_tokens(hunk) for hunk in hunks))
+    response = await create_chat_completion(prompt, max_tokens=max_tokens)
+    choice = response.choices[0]
+    feedback = choice.message.content or ""
+    logger.debug("Received feedback with %d characters", len(feedback))
+    logger.debug("Preview of feedback: %.100s...", feedback)
+    truncated = choice.finish_reason == "length"
+    # 只缓存非空且正常结束或因长度截断的回复；截断标记一并缓存，重新运行时按同样的方式只使用完整的部分
+    if choice.finish_reason in ("stop", "length") and feedback.strip():
+        save_cached_feedback(cache_path, feedback, truncated)
+    else:
+        logger.warning(f"Not caching feedback for {file_path}: finish_reason={choice.finish_reason}, length={len(feedback)}")
+    return feedback, truncated
+
+def make_review_comment(file_path, line_number, comment):
+    """构造一条待提交的行评论"""
     # 确保行号是一个有效的整数
     try:
         line_number = int(line_number)
@@ -167,101 +421,250 @@ def post_comment(pr_number, repo, commit_id, file_path, line_number, comment, he
         logger.warning(f"Invalid line number: {line_number}, using default line 1")
         line_number = 1
     
-    body = {
-        "body": comment,
-        "commit_id": commit_id,
+    return {
         "path": file_path,
         "line": line_number,
+        "body": comment,
         "side": "RIGHT"
     }
+
+def submit_review(review_url, commit_id, comments):
+    """提交一个包含 comments 的 review，返回 GitHub 的响应"""
+    body = {
+        "commit_id": commit_id,
+        "body": f"AI 代码审查：本次提交 {len(comments)} 条评论。",
+        "event": "COMMENT",
+        "comments": comments
+    }
     
-    # 如果提供了diff_hunk，添加到请求中
-    if diff_hunk:
-        body["diff_hunk"] = diff_hunk
-    
-    logger.info(f"Posting comment to {comment_url} for file {file_path} at line {line_number}")
-    logger.debug(f"Comment body: {json.dumps(body)}")
-    response = requests.post(comment_url, headers=headers, json=body)
-    if response.status_code == 201:
-        logger.info(f"Comment posted successfully, response code: {response.status_code}")
-        return True
+    logger.info(f"Posting review to {review_url} with {len(comments)} comments")
+    data = orjson.dumps(body)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Review body: %s", data.decode())
+    response = SESSION.post(review_url, data=data, headers={"Content-Type": "application/json"})
+    if response.status_code == 200:
+        logger.info(f"Review posted successfully, response code: {response.status_code}")
     else:
         logger.error(f"评论发布失败: {response.status_code}, {response.text}")
-        logger.debug(f"Response headers: {response.headers}")
+        logger.debug("Response headers: %s", response.headers)
+        
+        # 422 时整个 review 的评论都会被拒绝，记录这些评论的位置以便排查
+        if response.status_code == 422:
+            locations = ", ".join(f"{c['path']}:{c['line']}" for c in comments)
+            logger.error(f"Rejected review contained comments at: {locations}")
         
         # 如果失败，尝试获取更多错误信息
         try:
-            error_info = response.json()
-            logger.error(f"Error details: {json.dumps(error_info)}")
+            error_info = orjson.loads(response.content)
+            logger.error(f"Error details: {orjson.dumps(error_info).decode()}")
         except:
             pass
+    return response
+
+def post_review(pr_number, repo, commit_id, comments):
+    """将所有行评论合并为 Pull Request review 一次性提交，返回成功提交的评论数"""
+    review_url = f"https://api.github.com/repos/{repo}/pulls/{pr_number}/reviews"
+    posted_count = 0
+    
+    # 单个 review 的评论数有限制，超出时分批提交
+    for start in range(0, len(comments), REVIEW_BATCH_SIZE):
+        batch = comments[start:start + REVIEW_BATCH_SIZE]
+        response = submit_review(review_url, commit_id, batch)
+        if response.status_code == 200:
+            posted_count += len(batch)
+        elif response.status_code == 422 and len(batch) > 1:
+            # 一条无效评论会导致整批被拒绝，逐条重新提交，只丢弃无效的评论
+            logger.info(f"Resubmitting {len(batch)} comments one at a time")
+            for comment in batch:
+                if submit_review(review_url, commit_id, [comment]).status_code == 200:
+                    posted_count += 1
+    
+    return posted_count
+
+def get_hunk_hash(hunk):
+    """计算代码块正文的哈希，直接在 diff 的内存视图上计算，不复制正文"""
+    start, end = hunk["body_slice"]
+    return hashlib.blake2b(memoryview(hunk["diff_bytes"])[start:end], digest_size=16).digest()
+
+def has_added_code(hunk):
+    """判断代码块是否新增了非空白内容；纯删除或只改空白的代码块无需 AI 审查"""
+    start, end = hunk["body_slice"]
+    return _ADDED_CODE_RE.search(hunk["diff_bytes"], start, end) is not None
+
+async def produce_hunks(diff_chunks, hunk_queue, file_changes, consumer_count):
+    """边下载边解析 diff，把同一文件的代码块分组放入队列"""
+    file_iter = parse_diff(diff_chunks)
+    # 代码块正文哈希 -> 第一次出现的代码块；内容相同的代码块只分析一次
+    unique_hunks = {}
+    try:
+        while True:
+            # 读取和解析会阻塞，放到线程中执行，避免阻塞正在进行的 AI 请求
+            file_change = await asyncio.to_thread(next, file_iter, None)
+            if file_change is None:
+                break
+            
+            hunks = [hunk for hunk in file_change["hunks"] if has_added_code(hunk)]
+            skipped_count = len(file_change["hunks"]) - len(hunks)
+            if skipped_count:
+                logger.info(f"Skipping {skipped_count} hunks without added code in {file_change['file']}")
+            if not hunks:
+                continue
+            file_change["hunks"] = hunks
             
-        return False
+            file_changes.append(file_change)
+            new_hunks = []
+            for hunk in hunks:
+                hunk_hash = get_hunk_hash(hunk)
+                if hunk_hash in unique_hunks:
+                    hunk["duplicate_of"] = unique_hunks[hunk_hash]
+                else:
+                    unique_hunks[hunk_hash] = hunk
+                    new_hunks.append(hunk)
+            duplicate_count = len(hunks) - len(new_hunks)
+            if duplicate_count:
+                logger.info(f"Reusing feedback for {duplicate_count} duplicate hunks in {file_change['file']}")
+            
+            for batch in batch_hunks(new_hunks):
+                await hunk_queue.put((file_change["file"], batch))
+    except Exception as e:
+        # diff 下载或解析中途失败时，已解析出的代码块仍然继续审查
+        logger.error(f"Error during diff processing: {str(e)}")
+    finally:
+        # 通知所有消费者没有更多代码块
+        for _ in range(consumer_count):
+            await hunk_queue.put(None)
+
+def assign_feedback(feedback, hunks):
+    """把一次 AI 反馈按代码块编号拆分，评论记录在对应代码块的 comments 上"""
+    for hunk in hunks:
+        hunk["comments"] = []
+    for feedback_match in _FEEDBACK_RE.finditer(feedback):
+        hunk_number = int(feedback_match.group(1))
+        if not 1 <= hunk_number <= len(hunks):
+            logger.warning(f"Ignoring feedback for unknown hunk {hunk_number}")
+            continue
+        relative_line_number = int(feedback_match.group(2))
+        hunks[hunk_number - 1]["comments"].append((relative_line_number, feedback_match.group(3)))
+
+async def review_hunks(file_path, hunks):
+    """分析一组代码块并记录评论；回复被截断时只对未完成的代码块逐个重新分析"""
+    try:
+        feedback, truncated = await analyze_code_with_ai(file_path, hunks)
+    except Exception as e:
+        # 单个批次失败时不影响其他代码块的评论提交
+        logger.error(f"Error analyzing {len(hunks)} hunks of {file_path}: {str(e)}")
+        for hunk in hunks:
+            hunk["comments"] = []
+            hunk["analysis_failed"] = True
+        return
+    logger.info(f"AI feedback received for {file_path}, length: {len(feedback)} characters")
+    if not truncated:
+        assign_feedback(feedback, hunks)
+        return
+    
+    # 丢弃最后一行可能不完整的反馈
+    feedback = feedback[:feedback.rfind("\n") + 1]
+    if len(hunks) == 1:
+        logger.warning(f"Feedback for hunk {hunks[0]['header']} of {file_path} was truncated")
+        assign_feedback(feedback, hunks)
+        return
+    
+    # 编号小于最后出现的 Hunk 编号的代码块已经完整评论，保留其反馈，其余代码块逐个重新分析
+    hunk_numbers = [int(m.group(1)) for m in _FEEDBACK_RE.finditer(feedback)]
+    finished_count = min(hunk_numbers[-1] - 1, len(hunks)) if hunk_numbers else 0
+    assign_feedback(feedback, hunks)
+    remaining = hunks[max(finished_count, 0):]
+    logger.warning(f"Feedback for {len(hunks)} hunks of {file_path} was truncated, re-analyzing {len(remaining)} hunks one by one")
+    for hunk in remaining:
+        await review_hunks(file_path, [hunk])
 
-def main():
+async def consume_hunks(hunk_queue):
+    """从队列中取出一组代码块交给 AI 分析"""
+    while True:
+        item = await hunk_queue.get()
+        if item is None:
+            break
+        file_path, hunks = item
+        await review_hunks(file_path, hunks)
+
+async def main():
     logger.info("Starting code review process")
-    with open(GITHUB_EVENT_PATH, "r") as f:
-        event = json.load(f)
+    with open(GITHUB_EVENT_PATH, "rb") as f:
+        event = orjson.loads(f.read())
     pr_number = event["pull_request"]["number"]
     repo = event["repository"]["full_name"]
     commit_id = event["pull_request"]["head"]["sha"]
     logger.info(f"Processing PR #{pr_number} for repo {repo}, commit {commit_id}")
 
-    headers = {
+    SESSION.headers.update({
         "Authorization": f"Bearer {GITHUB_TOKEN}",
         "Accept": "application/vnd.github+json"
-    }
+    })
 
     try:
-        diff = get_pr_diff(pr_number, repo, headers)
-        logger.info(f"Successfully fetched diff, length: {len(diff)} characters")
-        logger.debug(f"Diff preview (first 10 lines):")
-        diff_lines = diff.splitlines()
-        for i in range(min(10, len(diff_lines))):
-            logger.debug(f"  {diff_lines[i]}")
-        file_changes = parse_diff(diff)
-        logger.info(f"Parsed {len(file_changes)} changed files")
+        diff_chunks = get_pr_diff(pr_number, repo, commit_id)
     except Exception as e:
         logger.error(f"Error during diff processing: {str(e)}")
         return
 
+    # 下载解析 diff 与 AI 分析流水线进行：解析出一个代码块就立即交给空闲的消费者
+    file_changes = []
+    hunk_queue = asyncio.Queue(maxsize=HUNK_QUEUE_SIZE)
+    logger.info(f"Analyzing hunks with concurrency {MAX_CONCURRENCY}")
+    await asyncio.gather(
+        produce_hunks(diff_chunks, hunk_queue, file_changes, MAX_CONCURRENCY),
+        *[consume_hunks(hunk_queue) for _ in range(MAX_CONCURRENCY)]
+    )
+    logger.info(f"Parsed {len(file_changes)} changed files")
+
+    review_comments = []
+
     for file_change in file_changes:
         file_path = file_change["file"]
         logger.info(f"Processing file: {file_path}")
         for hunk_index, hunk in enumerate(file_change["hunks"]):
-            diff_snippet = "\n".join(hunk["lines"])
-            logger.info(f"Analyzing hunk {hunk_index+1}/{len(file_change['hunks'])} starting at line {hunk['new_start']}")
-            
-            # 传递hunk信息给AI分析函数
-            feedback = analyze_code_with_ai(diff_snippet, hunk_info=hunk)
-            logger.info(f"AI feedback received, length: {len(feedback)} characters")
+            logger.info(f"Reviewing hunk {hunk_index+1}/{len(file_change['hunks'])} starting at line {hunk['new_start']}")
             
             comment_count = 0
-            success_count = 0
+            skipped_count = 0
             
-            # 处理AI反馈
-            for line in feedback.splitlines():
-                if line.startswith("- **Line"):
-                    line_number_match = re.match(r"- \*\*Line (\d+)\*\*: (.*)", line)
-                    if line_number_match:
-                        # 计算实际行号 - 相对行号 + 代码块起始行号 - 1
-                        relative_line_number = int(line_number_match.group(1))
-                        absolute_line_number = relative_line_number + hunk["new_start"] - 1
-                        comment = line_number_match.group(2)
-                        
-                        logger.info(f"Posting comment at line {absolute_line_number} (relative line {relative_line_number})")
-                        success = post_comment(pr_number, repo, commit_id, file_path, absolute_line_number, comment, headers)
-                        comment_count += 1
-                        if success:
-                            success_count += 1
+            # 处理AI反馈，重复的代码块沿用第一次出现时的反馈，按各自的起始行换算行号
+            source_hunk = hunk.get("duplicate_of", hunk)
+            line_numbers = get_new_line_numbers(hunk) if source_hunk.get("comments") else []
+            for relative_line_number, comment in source_hunk.get("comments", []):
+                # 相对行号按 diff 中显示的行计数，跳过删除的行换算为新文件中的行号
+                if not 1 <= relative_line_number <= len(line_numbers) or line_numbers[relative_line_number - 1] is None:
+                    logger.warning(f"Skipping comment at relative line {relative_line_number}, not a new-side line in hunk {hunk['header']}")
+                    skipped_count += 1
+                    continue
+                absolute_line_number = line_numbers[relative_line_number - 1]
+                
+                # 超出代码块范围的行 GitHub 会以 422 拒绝整个 review，提前丢弃
+                if not hunk["new_start"] <= absolute_line_number < hunk["new_start"] + hunk["new_count"]:
+                    logger.warning(f"Skipping comment at line {absolute_line_number}, outside hunk {hunk['header']}")
+                    skipped_count += 1
+                    continue
+                
+                logger.info(f"Queueing comment at line {absolute_line_number} (relative line {relative_line_number})")
+                review_comments.append(make_review_comment(file_path, absolute_line_number, comment))
+                comment_count += 1
             
-            logger.info(f"Posted {success_count}/{comment_count} comments for hunk {hunk_index+1}")
+            logger.info(f"Queued {comment_count} comments for hunk {hunk_index+1}, skipped {skipped_count}")
             
-            # 如果没有评论，尝试为整个代码块添加一个通用评论
-            if comment_count == 0:
+            # AI 分析失败的代码块没有结论，不能当作"没有发现问题"
+            if source_hunk.get("analysis_failed") or "comments" not in source_hunk:
+                logger.warning(f"Hunk {hunk_index+1} of {file_path} was not analyzed, skipping general comment")
+                continue
+            
+            # 只有 AI 完全没有给出行评论时，才为整个代码块添加一个通用评论
+            if comment_count + skipped_count == 0:
                 logger.info("No specific line comments found, adding a general comment for the hunk")
                 general_comment = f"AI审查了从第{hunk['new_start']}行开始的代码块，但没有发现具体问题。请人工检查此代码块。"
-                post_comment(pr_number, repo, commit_id, file_path, hunk["new_start"], general_comment, headers)
+                review_comments.append(make_review_comment(file_path, hunk["new_start"], general_comment))
+
+    if review_comments:
+        posted_count = post_review(pr_number, repo, commit_id, review_comments)
+        logger.info(f"Posted {posted_count}/{len(review_comments)} comments")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file